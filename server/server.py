@@ -1,7 +1,18 @@
+import asyncio
+import atexit
+import hashlib
+import inspect
 import logging
-from typing import List
+import logging.handlers
+import queue
+import threading
+import warnings
+from array import array
+from typing import Dict, List, Optional, Tuple
+from pygls.protocol import LanguageServerProtocol, lsp_method
 from pygls.server import LanguageServer
 from lsprotocol.types import (
+    INITIALIZE,
     InitializeParams,
     InitializeResult,
     ServerCapabilities,
@@ -14,134 +25,517 @@ from lsprotocol.types import (
     DidOpenTextDocumentParams,
     DidChangeTextDocumentParams,
     TextDocumentContentChangeEvent,
+    PositionEncodingKind,
 )
 
 import tree_sitter_systemverilog as tssverilog
-from tree_sitter import Language, Parser, Node
+from tree_sitter import Language, Parser, Node, Query, QueryCursor, Tree
 
 # Initialize SystemVerilog language
 SYSTEMVERILOG_LANGUAGE = Language(tssverilog.language())
 
+# Compiled once; matching runs entirely inside tree-sitter. MISSING nodes are
+# not queried: the (MISSING) pattern skips some of them, e.g. a missing
+# identifier at the start of a statement, so they are found by a walk instead
+ERROR_QUERY = Query(SYSTEMVERILOG_LANGUAGE, "(ERROR) @error")
+
+# Fraction of the document that top-level ERROR nodes may cover after an
+# incremental parse before falling back to a parse from scratch
+INCREMENTAL_ERROR_THRESHOLD = 0.5
+
+# Bounds on the work done per analysis, so pathological input cannot stall
+# diagnostics for seconds
+PARSE_TIMEOUT_MICROS = 500_000
+MAX_DOCUMENT_BYTES = 2_000_000
+
+# Beyond this many changed ranges and known errors, searching the whole tree
+# is cheaper than searching each range separately
+MAX_SEARCH_RANGES = 32
+
+# Shared by the diagnostics that have no location of their own
+_ZERO_RANGE = Range(start=Position(line=0, character=0), end=Position(line=0, character=0))
+
+class Doc:
+    """Per-document state kept by the server."""
+    __slots__ = ('buf', 'tree', 'line_starts', 'error_spans', 'edit_spans', 'version', 'last_hash', 'last_diag_hash')
+
+    def __init__(self, version: Optional[int] = None):
+        self.buf = bytearray()
+        self.tree: Optional[Tree] = None
+        self.line_starts = array('i', [0])
+        # Byte spans of the errors found by the last analysis, kept in step
+        # with the buffer as edits are applied
+        self.error_spans: List[Tuple[int, int]] = []
+        # Byte spans of the text inserted since the last analysis
+        self.edit_spans: List[Tuple[int, int]] = []
+        self.version = version
+        # Digest of the content last scheduled for analysis
+        self.last_hash: Optional[bytes] = None
+        # Hash of the diagnostics last published for this document
+        self.last_diag_hash: Optional[int] = None
+
+class SystemVerilogLanguageServerProtocol(LanguageServerProtocol):
+    @lsp_method(INITIALIZE)
+    def lsp_initialize(self, params: InitializeParams) -> InitializeResult:
+        """Negotiate UTF-8 positions when the client supports them.
+
+        pygls settles on UTF-16 whenever the client offers it, but UTF-8
+        positions map directly onto tree-sitter's byte columns.
+        """
+        # Our own wrapper already dispatches to the user-registered initialize
+        # feature, so skip the one around the base method if there is one
+        result = inspect.unwrap(LanguageServerProtocol.lsp_initialize)(self, params)
+        general = params.capabilities.general
+        if general and general.position_encodings and PositionEncodingKind.Utf8 in general.position_encodings:
+            # pygls' own workspace copy of the documents keeps the encoding it
+            # picked, but the server only reads its own buffers
+            result.capabilities.position_encoding = PositionEncodingKind.Utf8
+        self._server.position_encoding = result.capabilities.position_encoding
+        return result
+
 class SystemVerilogLanguageServer(LanguageServer):
     def __init__(self):
-        super().__init__('systemverilog-lsp', 'v0.1.0')
+        super().__init__('systemverilog-lsp', 'v0.1.0', protocol_cls=SystemVerilogLanguageServerProtocol)
         self.parser = Parser(SYSTEMVERILOG_LANGUAGE)
-        self.documents = {}
+        # The replacement progress_callback only applies to callback-driven
+        # parses, not to parsing an in-memory buffer
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            self.parser.timeout_micros = PARSE_TIMEOUT_MICROS
+        # Cancelled analyses may still be parsing in their worker thread
+        self._parser_lock = threading.Lock()
+        self.documents: Dict[str, Doc] = {}
+        # Negotiated during initialize; tree-sitter columns are UTF-8 bytes,
+        # so UTF-16 and UTF-32 columns have to be converted
+        self.position_encoding = PositionEncodingKind.Utf16
+        # Pending debounced analyses, keyed by document URI
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._debounce_ms = 100
 
-    def _apply_incremental_changes(self, text: str, changes: List[TextDocumentContentChangeEvent]) -> str:
-        """Apply incremental changes to the document text."""
-        lines = text.split('\n')
-        
-        # Sort changes by position (reverse order to avoid position shifts)
-        sorted_changes = sorted(changes, key=lambda c: (c.range.start.line, c.range.start.character), reverse=True)
-        
-        for change in sorted_changes:
-            if change.range is None:
-                # Full document replacement
-                return change.text
+    def _index_lines(self, buf: bytearray) -> array:
+        """Return the byte offset of the start of every line in the buffer."""
+        line_starts = array('i', [0])
+        i = buf.find(b'\n')
+        while i != -1:
+            line_starts.append(i + 1)
+            i = buf.find(b'\n', i + 1)
+        return line_starts
+
+    def _content_hash(self, buf: bytearray) -> bytes:
+        """Return a digest identifying the buffer content."""
+        return hashlib.blake2b(buf, digest_size=16).digest()
+
+    def _replace_document(self, doc: Doc, text: str):
+        """Replace the whole document content, discarding the cached tree."""
+        doc.buf = bytearray(text.encode('utf-8'))
+        doc.line_starts = self._index_lines(doc.buf)
+        doc.tree = None
+        doc.error_spans = []
+        doc.edit_spans = []
+
+    def _apply_incremental_changes(self, doc: Doc, changes: List[TextDocumentContentChangeEvent]):
+        """Apply incremental changes to the document buffer in place.
+
+        The cached syntax tree is edited alongside the buffer so that the next
+        parse can reuse the unchanged subtrees.
+        """
+        # Changes are applied in the order given: per the LSP spec each one is
+        # expressed against the document as left by the previous one, and the
+        # line index is kept current after every splice
+        for change in changes:
+            if getattr(change, "range", None) is None:
+                # Full document replacement (these events have no range attribute)
+                self._replace_document(doc, change.text)
+                continue
             
-            start_line = change.range.start.line
-            start_char = change.range.start.character
-            end_line = change.range.end.line
-            end_char = change.range.end.character
+            buf = doc.buf
+            line_starts = doc.line_starts
+            start_line, start_byte = self._position_to_byte(buf, line_starts, change.range.start)
+            end_line, end_byte = self._position_to_byte(buf, line_starts, change.range.end)
+            new_bytes = change.text.encode('utf-8')
             
-            # Handle single line change
-            if start_line == end_line:
-                line = lines[start_line]
-                lines[start_line] = line[:start_char] + change.text + line[end_char:]
+            if doc.tree is not None:
+                start_point = (start_line, start_byte - line_starts[start_line])
+                newline_count = new_bytes.count(b'\n')
+                if newline_count:
+                    new_end_point = (start_line + newline_count, len(new_bytes) - new_bytes.rfind(b'\n') - 1)
+                else:
+                    new_end_point = (start_line, start_point[1] + len(new_bytes))
+                doc.tree.edit(
+                    start_byte=start_byte,
+                    old_end_byte=end_byte,
+                    new_end_byte=start_byte + len(new_bytes),
+                    start_point=start_point,
+                    old_end_point=(end_line, end_byte - line_starts[end_line]),
+                    new_end_point=new_end_point,
+                )
+            
+            buf[start_byte:end_byte] = new_bytes
+            if doc.error_spans:
+                doc.error_spans = self._shift_spans(doc.error_spans, start_byte, end_byte, start_byte + len(new_bytes))
+            if doc.tree is not None:
+                # Changed ranges miss errors such as a MISSING token left by a
+                # deletion, so the edits themselves are searched too
+                doc.edit_spans = self._shift_spans(doc.edit_spans, start_byte, end_byte, start_byte + len(new_bytes))
+                doc.edit_spans.append((start_byte, start_byte + len(new_bytes)))
+            
+            # Re-index only the lines touched by the change and shift the rest
+            delta = len(new_bytes) - (end_byte - start_byte)
+            touched = array('i')
+            i = new_bytes.find(b'\n')
+            while i != -1:
+                touched.append(start_byte + i + 1)
+                i = new_bytes.find(b'\n', i + 1)
+            touched.extend(s + delta for s in line_starts[end_line + 1:])
+            line_starts[start_line + 1:] = touched
+
+    def _shift_spans(self, spans: List[Tuple[int, int]], start_byte: int, old_end_byte: int, new_end_byte: int) -> List[Tuple[int, int]]:
+        """Map byte spans through an edit.
+
+        Offsets after the edit move with it. Spans touching the replaced text
+        grow to cover the inserted text.
+        """
+        delta = new_end_byte - old_end_byte
+        return [
+            (s if s <= start_byte else s + delta if s >= old_end_byte else start_byte,
+             e if e < start_byte else e + delta if e >= old_end_byte else new_end_byte)
+            for s, e in spans
+        ]
+
+    def _merge_spans(self, spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """Sort byte spans and merge the ones that overlap or touch."""
+        merged = []
+        for s, e in sorted(spans):
+            if merged and s <= merged[-1][1]:
+                if e > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], e)
             else:
-                # Multi-line change
-                # Keep the part before the start position
-                before = lines[start_line][:start_char] if start_line < len(lines) else ""
-                # Keep the part after the end position
-                after = lines[end_line][end_char:] if end_line < len(lines) else ""
-                
-                # Replace the affected lines
-                new_lines = (before + change.text + after).split('\n')
-                lines[start_line:end_line + 1] = new_lines
+                merged.append((s, e))
+        return merged
+
+    def _position_to_byte(self, buf: bytearray, line_starts: array, position: Position):
+        """Convert an LSP position to a (line, byte offset) pair."""
+        line = position.line
+        if line >= len(line_starts):
+            # Positions past the end of the document clamp to the end
+            return len(line_starts) - 1, len(buf)
         
-        return '\n'.join(lines)
+        line_start = line_starts[line]
+        line_end = line_starts[line + 1] - 1 if line + 1 < len(line_starts) else len(buf)
+        if self.position_encoding == PositionEncodingKind.Utf8:
+            return line, min(line_start + position.character, line_end)
+        
+        line_bytes = buf[line_start:line_end]
+        if line_bytes.isascii():
+            return line, line_start + min(position.character, len(line_bytes))
+        line_text = line_bytes.decode('utf-8')
+        if self.position_encoding == PositionEncodingKind.Utf32:
+            return line, line_start + len(line_text[:position.character].encode('utf-8'))
+        # Count UTF-16 code units; a split surrogate pair is dropped
+        prefix = line_text.encode('utf-16-le')[:2 * position.character]
+        return line, line_start + len(prefix.decode('utf-16-le', 'ignore').encode('utf-8'))
+
+    def _parse(self, source: bytes, old_tree: Optional[Tree] = None) -> Tuple[Optional[Tree], bool]:
+        """Parse SystemVerilog code and return the syntax tree.
 
-    def _parse(self, text: str):
-        """Parse SystemVerilog code and return the syntax tree."""
+        When an edited ``old_tree`` is given, tree-sitter re-parses only the
+        subtrees affected by the edits. Also returns whether the tree was
+        actually parsed from ``old_tree``.
+        """
         try:
-            tree = self.parser.parse(bytes(text, "utf8"))
-            return tree
+            with self._parser_lock:
+                if old_tree is None:
+                    return self.parser.parse(source), False
+                
+                tree = self.parser.parse(source, old_tree=old_tree)
+                if tree.root_node.has_error and self._error_span(tree.root_node) > INCREMENTAL_ERROR_THRESHOLD * len(source):
+                    # Error recovery may have latched onto reused subtrees; don't trust it
+                    logging.info("Incremental parse produced large error spans, re-parsing from scratch")
+                    return self.parser.parse(source), False
+                return tree, True
+        except ValueError:
+            # tree-sitter gives up once timeout_micros has elapsed; the parser
+            # must be reset or the next call would resume this parse
+            self.parser.reset()
+            raise TimeoutError(f"Parsing {len(source)} bytes took longer than {PARSE_TIMEOUT_MICROS} us")
         except Exception as e:
-            logging.error(f"Parse error: {e}")
-            return None
+            logging.error("Parse error: %s", e)
+            return None, False
+
+    def _error_span(self, root_node: Node) -> int:
+        """Return the number of bytes covered by top-level ERROR nodes."""
+        if root_node.type == "ERROR":
+            return root_node.end_byte - root_node.start_byte
+        return sum(c.end_byte - c.start_byte for c in root_node.children if c.type == "ERROR")
 
-    def _node_to_range(self, node: 'Node') -> Range:
+    def _node_to_range(self, node: 'Node', source: bytes) -> Range:
         """Convert tree-sitter node to LSP Range."""
-        return Range(
-            start=Position(line=node.start_point[0], character=node.start_point[1]),
-            end=Position(line=node.end_point[0], character=node.end_point[1]),
-        )
+        start = self._point_to_position(node.start_point, node.start_byte, source)
+        if node.end_byte == node.start_byte:
+            # Zero-width (MISSING) nodes start and end at the same position
+            return Range(start=start, end=start)
+        return Range(start=start, end=self._point_to_position(node.end_point, node.end_byte, source))
+
+    def _point_to_position(self, point, offset: int, source: bytes) -> Position:
+        """Convert a tree-sitter point (byte column) to an LSP position."""
+        row, column = point
+        if column and self.position_encoding != PositionEncodingKind.Utf8:
+            prefix = source[offset - column:offset]
+            if not prefix.isascii():
+                prefix_text = prefix.decode('utf-8', 'replace')
+                if self.position_encoding == PositionEncodingKind.Utf32:
+                    column = len(prefix_text)
+                else:
+                    column = len(prefix_text.encode('utf-16-le')) // 2
+        return Position(line=row, character=column)
+
+    def _get_diagnostics(self, tree, source: bytes, search_ranges: Optional[List[Tuple[int, int]]] = None) -> Tuple[List[Diagnostic], List[Tuple[int, int]]]:
+        """Generate diagnostics for syntax errors only.
 
-    def _get_diagnostics(self, tree, text: str) -> List[Diagnostic]:
-        """Generate diagnostics for syntax errors only."""
+        Also returns the byte spans of the nodes the diagnostics were made
+        for. If ``search_ranges`` is given, only errors intersecting those
+        byte ranges are looked for.
+        """
         diagnostics = []
         
         if not tree:
             return [Diagnostic(
-                range=Range(start=Position(line=0, character=0), 
-                           end=Position(line=0, character=0)),
+                range=_ZERO_RANGE,
                 severity=DiagnosticSeverity.Error,
                 message="Failed to parse Verilog code - tree-sitter parser not available"
-            )]
+            )], []
         
         root_node = tree.root_node
+        if not root_node.has_error:
+            # Clean tree, nothing to report
+            return diagnostics, []
         
         # Only check for actual ERROR nodes, not just has_error flag
         # The has_error flag can be true even for recoverable syntax issues
-        diagnostics.extend(self._find_syntax_errors(root_node, text))
+        errors, error_spans = self._find_syntax_errors(root_node, source, search_ranges)
+        if not errors and search_ranges is not None:
+            # The error lies outside the searched ranges after all
+            errors, error_spans = self._find_syntax_errors(root_node, source)
+        diagnostics.extend(errors)
         
         # If no specific errors found but tree has error flag, it might be a parser limitation
         if not diagnostics and root_node.has_error:
-            logging.warning(f"Tree has error flag but no specific errors found. Root node type: {root_node.type}")
+            logging.warning("Tree has error flag but no specific errors found. Root node type: %s", root_node.type)
             # Don't report a generic error - let the specific error nodes be found
         
-        return diagnostics
+        return diagnostics, error_spans
 
-    def _find_syntax_errors(self, node: 'Node', text: str) -> List[Diagnostic]:
-        """Find syntax errors in the parse tree."""
+    def _find_syntax_errors(self, node: 'Node', source: bytes, search_ranges: Optional[List[Tuple[int, int]]] = None) -> Tuple[List[Diagnostic], List[Tuple[int, int]]]:
+        """Find syntax errors in the parse tree, along with their byte spans."""
         diagnostics = []
+        query_cursor = QueryCursor(ERROR_QUERY)
+        error_nodes = {}
         
-        def traverse(n):
+        if search_ranges is None:
+            # ERROR and MISSING nodes can only occur inside subtrees flagged with
+            # has_error, so clean top-level items are never searched
+            subtrees = [node] if node.type == "ERROR" else [c for c in node.children if c.has_error]
+            for subtree in subtrees:
+                for n in self._capture_errors(query_cursor, subtree):
+                    error_nodes[n.id] = n
+                for n in self._find_missing(subtree):
+                    error_nodes[n.id] = n
+        else:
+            for start_byte, end_byte in search_ranges:
+                # Widen by a byte so zero-width MISSING nodes on the edge still
+                # count as intersecting
+                query_cursor.set_byte_range(max(start_byte - 1, 0), end_byte + 1)
+                for n in self._capture_errors(query_cursor, node):
+                    error_nodes[n.id] = n
+                for n in self._find_missing(node, max(start_byte - 1, 0), end_byte + 1):
+                    error_nodes[n.id] = n
+        
+        error_nodes = sorted(error_nodes.values(), key=lambda n: n.start_byte)
+        for n in error_nodes:
             # Only report actual ERROR nodes
             if n.type == "ERROR":
-                error_text = text[n.start_byte:n.end_byte]
+                # Node offsets are byte offsets into the UTF-8 source
+                error_text = source[n.start_byte:n.end_byte].decode('utf-8', 'replace')
                 diagnostics.append(Diagnostic(
-                    range=self._node_to_range(n),
+                    range=self._node_to_range(n, source),
                     severity=DiagnosticSeverity.Error,
                     message=f"Syntax error: '{error_text}'"
                 ))
-                logging.info(f"Found ERROR node: '{error_text}' at {n.start_point}-{n.end_point}")
-            elif n.is_missing:
+            else:
                 diagnostics.append(Diagnostic(
-                    range=self._node_to_range(n),
+                    range=self._node_to_range(n, source),
                     severity=DiagnosticSeverity.Error,
                     message="Missing token"
                 ))
-                logging.info(f"Found missing node at {n.start_point}-{n.end_point}")
-            
-            for child in n.children:
-                traverse(child)
         
-        traverse(node)
-        logging.info(f"Found {len(diagnostics)} syntax errors")
-        return diagnostics
-
-    def _analyze_document(self, text: str) -> List[Diagnostic]:
-        """Analyze the document and return syntax error diagnostics."""
-        tree = self._parse(text)
-        if tree:
-            logging.info(f"Successfully parsed document. Root node: {tree.root_node.type}, Has error: {tree.root_node.has_error}")
-        else:
+        return diagnostics, [(n.start_byte, n.end_byte) for n in error_nodes]
+
+    def _capture_errors(self, query_cursor: QueryCursor, node: Node) -> List[Node]:
+        """Run the error query over a node and return the matched nodes."""
+        return query_cursor.captures(node).get("error", [])
+
+    def _find_missing(self, node: Node, start_byte: Optional[int] = None, end_byte: Optional[int] = None) -> List[Node]:
+        """Return the MISSING nodes under a node.
+
+        Only children flagged with has_error can hold one, so clean subtrees
+        are never entered. If a byte range is given, subtrees outside it are
+        skipped too.
+        """
+        if node.is_missing:
+            return [node]
+        missing = []
+        cursor = node.walk()
+        if not cursor.goto_first_child():
+            return missing
+        
+        while True:
+            n = cursor.node
+            if n.has_error or n.is_missing:
+                if start_byte is None or (n.start_byte <= end_byte and n.end_byte >= start_byte):
+                    if n.is_missing:
+                        missing.append(n)
+                    elif cursor.goto_first_child():
+                        continue
+            # Move on to the next sibling, climbing back up once the siblings
+            # are exhausted or lie past the range
+            while not (cursor.goto_next_sibling() and (end_byte is None or cursor.node.start_byte <= end_byte)):
+                if not cursor.goto_parent():
+                    return missing
+
+    def _analyze_document(self, source: bytes, old_tree: Optional[Tree], error_spans: List[Tuple[int, int]], edit_spans: List[Tuple[int, int]]):
+        """Parse the document and return the new tree, its syntax error
+        diagnostics and the byte spans of the errors.
+
+        ``error_spans`` are the spans found by the previous analysis and
+        ``edit_spans`` the spans of the text inserted since, both mapped
+        through the edits made since. When re-parsing incrementally only
+        those spans and the ranges that changed between ``old_tree`` and the
+        new tree can hold errors, so the rest of the tree is not searched.
+
+        The diagnostics are None if parsing timed out, in which case the
+        previous results should be kept. Runs in a worker thread, so it must
+        not touch the stored documents.
+        """
+        if len(source) > MAX_DOCUMENT_BYTES:
+            logging.warning("Document too large to analyze (%d bytes)", len(source))
+            return None, [], []
+        
+        try:
+            tree, incremental = self._parse(source, old_tree)
+        except TimeoutError as e:
+            logging.warning("%s, keeping previous diagnostics", e)
+            return None, None, error_spans
+        if not tree:
             logging.error("Failed to parse document")
-        diagnostics = self._get_diagnostics(tree, text)
-        logging.info(f"Generated {len(diagnostics)} diagnostics")
-        return diagnostics
+        
+        search_ranges = None
+        ranges = None
+        if incremental:
+            # Changed ranges are only meaningful against the tree that was
+            # actually re-parsed, so a parse from scratch is searched in full
+            ranges = self._merge_spans(
+                [(r.start_byte, r.end_byte) for r in old_tree.changed_ranges(tree)] + error_spans + edit_spans
+            )
+        if ranges is not None and len(ranges) <= MAX_SEARCH_RANGES:
+            # Changed ranges say nothing about zero-width MISSING nodes, which
+            # may move across the comments next to a change, so widen every
+            # range out to the surrounding tokens
+            search_ranges = [
+                (self._prev_token_end(tree.root_node, start), self._next_token_start(tree.root_node, end))
+                for start, end in ranges
+            ]
+        diagnostics, error_spans = self._get_diagnostics(tree, source, search_ranges)
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("Analyzed %d bytes (incremental: %s), %d diagnostics", len(source), incremental, len(diagnostics))
+        return tree, diagnostics, error_spans
+
+    def _next_token_start(self, root_node: Node, offset: int) -> int:
+        """Return the start of the first non-extra token at or after ``offset``."""
+        cursor = root_node.walk()
+        while cursor.goto_first_child_for_byte(offset) is not None:
+            pass
+        
+        while True:
+            node = cursor.node
+            if node.child_count == 0 and not node.is_extra and node.start_byte >= offset:
+                return node.start_byte
+            if node.is_extra or node.end_byte < offset or not cursor.goto_first_child():
+                while not cursor.goto_next_sibling():
+                    if not cursor.goto_parent():
+                        return root_node.end_byte
+
+    def _prev_token_end(self, root_node: Node, offset: int) -> int:
+        """Return the end of the last non-extra token at or before ``offset``."""
+        cursor = root_node.walk()
+        while cursor.goto_first_child_for_byte(offset) is not None:
+            pass
+        
+        while True:
+            node = cursor.node
+            if node.child_count == 0 or node.is_extra:
+                if not node.is_extra and node.end_byte <= offset:
+                    return node.end_byte
+            elif node.start_byte < offset and cursor.goto_last_child():
+                continue
+            while not cursor.goto_previous_sibling():
+                if not cursor.goto_parent():
+                    return 0
+
+    def _schedule_analysis(self, uri: str, delay_ms: int = 0):
+        """(Re)start the analysis of a document after ``delay_ms``.
+
+        Any analysis still pending for the same document is cancelled, so a
+        burst of edits results in a single parse once typing pauses.
+        """
+        self._cancel_analysis(uri)
+        self._pending[uri] = asyncio.create_task(self._debounced_analyze(uri, delay_ms))
+
+    def _cancel_analysis(self, uri: str):
+        """Cancel the pending analysis of a document, if any."""
+        task = self._pending.pop(uri, None)
+        if task:
+            task.cancel()
+
+    async def _debounced_analyze(self, uri: str, delay_ms: int):
+        """Analyze a document after a delay and publish diagnostics.
+
+        The analysis runs in a worker thread, but tree-sitter holds the GIL
+        while parsing, so only collecting the diagnostics actually runs
+        alongside the event loop. The parse itself still stalls the loop, for
+        at most PARSE_TIMEOUT_MICROS. If the task is cancelled by a newer edit
+        meanwhile, the stale result is simply dropped.
+        """
+        try:
+            if delay_ms:
+                await asyncio.sleep(delay_ms / 1000)
+            doc = self.documents.get(uri)
+            if doc is None:
+                return
+            # The cached tree and buffer keep being edited on the event loop
+            # while the worker runs, so hand the worker its own copies. A
+            # tree keeps the buffer it was parsed from alive, so parsing a
+            # view of doc.buf would not save the copy
+            old_tree = doc.tree.copy() if doc.tree else None
+            tree, diagnostics, error_spans = await asyncio.to_thread(
+                self._analyze_document, bytes(doc.buf), old_tree, doc.error_spans, doc.edit_spans
+            )
+            if diagnostics is None:
+                return
+            doc.tree = tree
+            doc.error_spans = error_spans
+            doc.edit_spans = []
+            
+            # Whitespace and comment edits usually leave the diagnostics as they were
+            diag_hash = hash(tuple(
+                (d.range.start.line, d.range.start.character, d.range.end.line, d.range.end.character, d.message)
+                for d in diagnostics
+            ))
+            if diag_hash != doc.last_diag_hash:
+                doc.last_diag_hash = diag_hash
+                self.publish_diagnostics(uri, diagnostics, doc.version)
+        finally:
+            if self._pending.get(uri) is asyncio.current_task():
+                del self._pending[uri]
 
 server = SystemVerilogLanguageServer()
 
@@ -152,44 +546,52 @@ async def did_open(ls: SystemVerilogLanguageServer, params: DidOpenTextDocumentP
     text = params.text_document.text
     
     # Store document content
-    ls.documents[uri] = text
+    ls._cancel_analysis(uri)
+    doc = ls.documents[uri] = Doc(params.text_document.version)
+    ls._replace_document(doc, text)
+    doc.last_hash = ls._content_hash(doc.buf)
     
     # Analyze and publish diagnostics
-    diagnostics = ls._analyze_document(text)
-    ls.publish_diagnostics(uri, diagnostics)
+    ls._schedule_analysis(uri)
     
-    logging.info(f"Opened document: {uri}")
+    logging.info("Opened document: %s", uri)
 
 @server.feature('textDocument/didChange') 
 async def did_change(ls: SystemVerilogLanguageServer, params: DidChangeTextDocumentParams):
     """Handle document change event."""
     uri = params.text_document.uri
-    logging.info(f"Document changed: {uri}, Changes: {len(params.content_changes)}")
+    logging.info("Document changed: %s, Changes: %d", uri, len(params.content_changes))
     
     if not params.content_changes:
         logging.warning("Received didChange with no content changes")
         return
     
-    current_text = ls.documents.get(uri, "")
+    doc = ls.documents.get(uri)
+    if doc is None:
+        doc = ls.documents[uri] = Doc()
+    doc.version = params.text_document.version
     
     # Check if this is a full document update or incremental changes
     first_change = params.content_changes[0]
     
-    if first_change.range is None:
+    if getattr(first_change, "range", None) is None:
         # Full document replacement
-        new_text = first_change.text
         logging.info("Received full document update")
     else:
         # Incremental changes
-        logging.info(f"Received {len(params.content_changes)} incremental changes")
-        new_text = ls._apply_incremental_changes(current_text, params.content_changes)
+        logging.info("Received %d incremental changes", len(params.content_changes))
+    ls._apply_incremental_changes(doc, params.content_changes)
     
-    # Update stored document content
-    ls.documents[uri] = new_text
+    # Formatter round-trips and undo/redo can land on content that was
+    # already analyzed; the pending or published result still holds then
+    content_hash = ls._content_hash(doc.buf)
+    if content_hash == doc.last_hash:
+        logging.info("Content unchanged, skipping analysis")
+        return
+    doc.last_hash = content_hash
     
-    # Re-analyze and publish diagnostics
-    diagnostics = ls._analyze_document(new_text)
-    ls.publish_diagnostics(uri, diagnostics)
+    # Re-analyze and publish diagnostics once the edits settle
+    ls._schedule_analysis(uri, ls._debounce_ms)
 
 @server.feature('initialize')
 async def initialize(ls: SystemVerilogLanguageServer, params: InitializeParams) -> InitializeResult:
@@ -206,12 +608,19 @@ async def initialize(ls: SystemVerilogLanguageServer, params: InitializeParams)
     )
 
 if __name__ == "__main__":
+    # Log records are only queued on the event loop; a listener thread does
+    # the file and stream I/O
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue,
+        logging.FileHandler('verilog-lsp.log'),
+        logging.StreamHandler()
+    )
+    listener.start()
+    atexit.register(listener.stop)
     logging.basicConfig(
         level=logging.CRITICAL,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('verilog-lsp.log'),
-            logging.StreamHandler()
-        ]
+        handlers=[logging.handlers.QueueHandler(log_queue)]
     )
     server.start_io()
\ No newline at end of file
@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+
+from lsprotocol.types import (
+    DidChangeTextDocumentParams,
+    DidOpenTextDocumentParams,
+    Position,
+    Range,
+    TextDocumentContentChangeEvent_Type1,
+    TextDocumentItem,
+    VersionedTextDocumentIdentifier,
+)
+
+import server
+
+URI = 'file:///top.sv'
+
+CLEAN_MODULE = """module top (
+  input logic clk
+);
+  logic clk, rst_n;
+endmodule
+"""
+
+
+class IncrementalDiagnosticsTest(unittest.TestCase):
+    def setUp(self):
+        self.ls = server.SystemVerilogLanguageServer()
+        self.ls._debounce_ms = 0
+        self.published = {}
+        self.ls.publish_diagnostics = lambda uri, diagnostics, version=None: self.published.__setitem__(uri, diagnostics)
+
+    async def _settle(self):
+        while self.ls._pending:
+            await asyncio.sleep(0.001)
+
+    async def _open(self, text):
+        await server.did_open(self.ls, DidOpenTextDocumentParams(
+            text_document=TextDocumentItem(uri=URI, language_id='systemverilog', version=1, text=text)
+        ))
+        await self._settle()
+
+    async def _change(self, version, start, end, text):
+        await server.did_change(self.ls, DidChangeTextDocumentParams(
+            text_document=VersionedTextDocumentIdentifier(uri=URI, version=version),
+            content_changes=[TextDocumentContentChangeEvent_Type1(range=Range(start=start, end=end), text=text)],
+        ))
+        await self._settle()
+
+    def test_deleted_semicolon_in_clean_file_is_reported(self):
+        async def run():
+            await self._open(CLEAN_MODULE)
+            self.assertEqual(self.published.get(URI, []), [])
+            # Delete the ';' after rst_n
+            await self._change(2, Position(line=3, character=18), Position(line=3, character=19), '')
+        asyncio.run(run())
+
+        diagnostics = self.published[URI]
+        self.assertEqual([d.message for d in diagnostics], ["Missing token"])
+        self.assertEqual(diagnostics[0].range.start, Position(line=3, character=18))
+
+
+if __name__ == '__main__':
+    unittest.main()